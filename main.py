@@ -1,235 +1,400 @@
 import asyncio
+import hashlib
+import random
+import sys
 import time
 from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
 
-import httpx
+import aiohttp
 import aiosqlite
+import cachetools
+import orjson
 from iso3166 import countries_by_alpha2
-from fastapi import FastAPI, Request, Query
+from fastapi import FastAPI, Request, Query, Response
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
 
 DATA_DIR = Path("data")
 DATA_DIR.mkdir(exist_ok=True)
 DB_PATH = DATA_DIR / "leaderboard.db"
 REGIONS = ["americas", "europe", "se_asia", "china"]
 API_URL = "https://www.dota2.com/webapi/ILeaderboard/GetDivisionLeaderboard/v0001"
-
-
-async def init_db():
+REGION_TIMEOUT = 10
+MAX_RANK = 100_000
+ALPHA2_TO_NAME = {code: country.name for code, country in countries_by_alpha2.items()}
+
+# Per-region country lists; cleared whenever new leaderboard data is saved.
+_countries_cache: dict[str, dict[str, str]] = {}
+_cache_version = 0
+# Latest metadata row plus per-region last_updated; loaded lazily and replaced by save_to_db.
+_metadata_cache: dict | None = None
+# Rendered pages keyed by ETag, which already covers filters and data version.
+_page_cache: cachetools.LRUCache = cachetools.LRUCache(maxsize=512)
+
+
+async def connect_db() -> aiosqlite.Connection:
+    """Open a long-lived SQLite connection."""
+    db = await aiosqlite.connect(DB_PATH)
+    db.row_factory = aiosqlite.Row
+    await db.execute("PRAGMA busy_timeout=5000")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA cache_size=-20000")
+    await db.execute("PRAGMA mmap_size=268435456")
+    return db
+
+
+async def init_db(db: aiosqlite.Connection):
     """Initialize SQLite database."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-                         CREATE TABLE IF NOT EXISTS players
-                         (
-                             id INTEGER PRIMARY KEY AUTOINCREMENT,
-                             region TEXT NOT NULL,
-                             rank INTEGER NOT NULL,
-                             name TEXT NOT NULL,
-                             team_id INTEGER,
-                             team_tag TEXT,
-                             sponsor TEXT,
-                             country TEXT,
-                             UNIQUE
-                         (
-                             region,
-                             rank
+    async with db.execute("PRAGMA journal_mode=WAL") as cursor:
+        (journal_mode,) = await cursor.fetchone()
+    if journal_mode != "wal":
+        print(f"WAL mode unavailable, using journal_mode={journal_mode}")
+
+    await db.execute("""
+                     CREATE TABLE IF NOT EXISTS players
+                     (
+                         id INTEGER PRIMARY KEY AUTOINCREMENT,
+                         region TEXT NOT NULL,
+                         rank INTEGER NOT NULL,
+                         name TEXT NOT NULL,
+                         team_id INTEGER,
+                         team_tag TEXT,
+                         sponsor TEXT,
+                         country TEXT,
+                         UNIQUE
+                     (
+                         region,
+                         rank
+                     )
                          )
-                             )
-                         """)
+                     """)
+    await db.execute("""
+                     CREATE TABLE IF NOT EXISTS regions
+                     (
+                         region TEXT PRIMARY KEY,
+                         last_updated INTEGER NOT NULL
+                     )
+                     """)
+    async with db.execute("PRAGMA table_info(metadata)") as cursor:
+        metadata_columns = {row[1] for row in await cursor.fetchall()}
+    if "key" in metadata_columns:
+        # Migrate the old key/value layout in one transaction; SQLite DDL is transactional.
+        await db.execute("BEGIN")
+        await db.execute("ALTER TABLE metadata RENAME TO metadata_old")
+
+    await db.execute("""
+                     CREATE TABLE IF NOT EXISTS metadata
+                     (
+                         id INTEGER PRIMARY KEY CHECK (id = 1),
+                         time_posted INTEGER,
+                         next_scheduled_post_time INTEGER
+                     ) WITHOUT ROWID
+                     """)
+
+    if "key" in metadata_columns:
         await db.execute("""
-                         CREATE TABLE IF NOT EXISTS metadata
-                         (
-                             key TEXT PRIMARY KEY,
-                             value INTEGER
-                         )
+                         INSERT INTO metadata (id, time_posted, next_scheduled_post_time)
+                         SELECT 1,
+                                (SELECT value FROM metadata_old WHERE key = 'time_posted'),
+                                (SELECT value FROM metadata_old WHERE key = 'next_scheduled_post_time')
                          """)
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_region ON players(region)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_country ON players(country)")
+        await db.execute("DROP TABLE metadata_old")
         await db.commit()
 
+    # UNIQUE(region, rank) already indexes region lookups.
+    await db.execute("DROP INDEX IF EXISTS idx_region")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_country ON players(country)")
+    await db.execute("UPDATE players SET country = UPPER(country) WHERE country <> UPPER(country)")
+    await db.commit()
+
 
-async def fetch_leaderboards() -> dict | None:
+def create_http_session() -> aiohttp.ClientSession:
+    """Create a long-lived HTTP session for the Dota 2 API."""
+    return aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=30),
+        connector=aiohttp.TCPConnector(limit=16, ttl_dns_cache=300, keepalive_timeout=60),
+    )
+
+
+async def fetch_region(session: aiohttp.ClientSession, region: str) -> dict:
+    """Fetch raw leaderboard payload for a single region."""
+    async with session.get(
+            API_URL,
+            params={"division": region, "leaderboard": 0},
+            timeout=aiohttp.ClientTimeout(total=REGION_TIMEOUT),
+    ) as response:
+        response.raise_for_status()
+        return orjson.loads(await response.read())
+
+
+async def fetch_leaderboards(session: aiohttp.ClientSession) -> dict | None:
     """Fetch leaderboard data from Dota 2 API."""
     database = {}
+    region_time_posted = {}
     latest_time_posted = 0
     latest_next_update = 0
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        tasks = [
-            client.get(API_URL, params={"division": region, "leaderboard": 0})
-            for region in REGIONS
-        ]
-        responses = await asyncio.gather(*tasks, return_exceptions=True)
+    responses = await asyncio.gather(
+        *[fetch_region(session, region) for region in REGIONS],
+        return_exceptions=True,
+    )
 
-    for region, response in zip(REGIONS, responses):
-        if isinstance(response, Exception):
-            print(f"Error fetching {region}: {response}")
+    for region, data in zip(REGIONS, responses):
+        if isinstance(data, Exception):
+            print(f"Error fetching {region}: {data}")
             continue
 
-        data = response.json()
-        leaderboard = data.get("leaderboard", [])
-        for idx, player in enumerate(leaderboard, start=1):
-            player["rank"] = idx
-        database[region] = leaderboard
+        database[region] = data.get("leaderboard", [])
 
         tp = data.get("time_posted", 0)
         np = data.get("next_scheduled_post_time", 0)
+        region_time_posted[region] = tp
         latest_time_posted = max(latest_time_posted, tp)
         latest_next_update = max(latest_next_update, np)
 
     if not database:
         return None
+    print(f"Fetched {len(database)}/{len(REGIONS)} regions")
 
+    database["region_time_posted"] = region_time_posted
     database["time_posted"] = latest_time_posted
     database["next_scheduled_post_time"] = latest_next_update
     return database
 
 
-async def save_to_db(data: dict):
-    """Save leaderboard data to SQLite."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        for region in REGIONS:
-            players = data.get(region, [])
-            if not players:
-                continue
-
-            await db.execute("DELETE FROM players WHERE region = ?", (region,))
-
-            await db.executemany(
-                """INSERT INTO players (region, rank, name, team_id, team_tag, sponsor, country)
-                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                [
-                    (
-                        region,
-                        p.get("rank"),
-                        p.get("name", ""),
-                        p.get("team_id"),
-                        p.get("team_tag"),
-                        p.get("sponsor"),
-                        p.get("country"),
-                    )
-                    for p in players
-                ],
+async def save_to_db(db: aiosqlite.Connection, data: dict) -> list[str]:
+    """Save leaderboard data to SQLite in a single transaction.
+
+    Only regions that returned players and are newer than the stored
+    snapshot are replaced; every other region keeps its previous rows.
+    Metadata never moves backwards. Returns the regions that were saved.
+    """
+    region_time_posted = data.get("region_time_posted", {})
+
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        async with db.execute("SELECT region, last_updated FROM regions") as cursor:
+            last_updated = {row[0]: row[1] for row in await cursor.fetchall()}
+
+        regions = [
+            region for region in REGIONS
+            if data.get(region) and region_time_posted.get(region, 0) > last_updated.get(region, -1)
+        ]
+        if not regions:
+            await db.rollback()
+            return []
+
+        async with db.execute("SELECT time_posted, next_scheduled_post_time FROM metadata") as cursor:
+            stored = await cursor.fetchone()
+        metadata = {
+            "time_posted": max(data.get("time_posted", 0), (stored and stored[0]) or 0),
+            "next_scheduled_post_time": max(
+                data.get("next_scheduled_post_time", 0), (stored and stored[1]) or 0
+            ),
+        }
+
+        rows = [
+            (
+                region,
+                idx,
+                p.get("name", ""),
+                p.get("team_id"),
+                p.get("team_tag"),
+                p.get("sponsor"),
+                (p.get("country") or "").upper() or None,
             )
+            for region in regions
+            for idx, p in enumerate(data[region], start=1)
+        ]
 
-        await db.execute(
-            "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
-            ("time_posted", data.get("time_posted", 0)),
+        placeholders = ",".join("?" * len(regions))
+        await db.execute(f"DELETE FROM players WHERE region IN ({placeholders})", regions)
+        await db.executemany(
+            """INSERT INTO players (region, rank, name, team_id, team_tag, sponsor, country)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            rows,
+        )
+        await db.executemany(
+            "INSERT OR REPLACE INTO regions (region, last_updated) VALUES (?, ?)",
+            [(region, region_time_posted.get(region, 0)) for region in regions],
         )
         await db.execute(
-            "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
-            ("next_scheduled_post_time", data.get("next_scheduled_post_time", 0)),
+            "INSERT OR REPLACE INTO metadata (id, time_posted, next_scheduled_post_time) VALUES (1, ?, ?)",
+            (metadata["time_posted"], metadata["next_scheduled_post_time"]),
         )
-        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    await db.commit()
+
+    global _cache_version, _metadata_cache
+    _cache_version += 1
+    _countries_cache.clear()
+    _page_cache.clear()
+    last_updated.update((region, region_time_posted.get(region, 0)) for region in regions)
+    _metadata_cache = {**metadata, "regions": last_updated}
+    return regions
+
+
+@lru_cache(maxsize=64)
+def build_players_query(
+        has_rank_range: bool,
+        country_count: int,
+        team: str | None,
+        has_name: bool,
+) -> str:
+    """Build the players query for a given filter shape."""
+    query = "SELECT rank, name, team_id, team_tag, sponsor, country FROM players WHERE region = ?"
+
+    if has_rank_range:
+        query += " AND rank BETWEEN ? AND ?"
+
+    if country_count:
+        placeholders = ",".join("?" * country_count)
+        query += f" AND country IN ({placeholders})"
+
+    if team == "yes":
+        query += " AND COALESCE(team_tag, '') <> ''"
+    elif team == "no":
+        query += " AND COALESCE(team_tag, '') = ''"
+
+    if has_name:
+        query += " AND LOWER(name) LIKE ?"
+
+    return query + " ORDER BY rank"
 
 
 async def get_players(
+        db: aiosqlite.Connection,
         region: str,
         rank_from: int | None = None,
         rank_to: int | None = None,
         countries: list[str] | None = None,
         team: str | None = None,
         name_player: str | None = None,
-) -> list[dict]:
+) -> list[aiosqlite.Row]:
     """Get players from database with filters."""
-    query = "SELECT rank, name, team_id, team_tag, sponsor, country FROM players WHERE region = ?"
-    params: list = [region]
-
-    if rank_from and rank_to:
-        query += " AND rank BETWEEN ? AND ?"
-        params.extend([rank_from, rank_to])
+    has_rank_range = rank_from is not None or rank_to is not None
+    query = build_players_query(
+        has_rank_range,
+        len(countries) if countries else 0,
+        team if team in ("yes", "no") else None,
+        bool(name_player),
+    )
 
+    params: list = [region]
+    if has_rank_range:
+        params.append(rank_from if rank_from is not None else 1)
+        params.append(rank_to if rank_to is not None else sys.maxsize)
     if countries:
-        placeholders = ",".join("?" * len(countries))
-        query += f" AND UPPER(country) IN ({placeholders})"
         params.extend(countries)
-
-    if team == "yes":
-        query += " AND team_tag IS NOT NULL AND team_tag != ''"
-    elif team == "no":
-        query += " AND (team_tag IS NULL OR team_tag = '')"
-
     if name_player:
-        query += " AND LOWER(name) LIKE ?"
         params.append(f"{name_player.lower()}%")
 
-    query += " ORDER BY rank"
+    async with db.execute(query, params) as cursor:
+        return list(await cursor.fetchall())
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(query, params) as cursor:
-            rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
 
+async def get_metadata(db: aiosqlite.Connection) -> dict:
+    """Get metadata, reading the database only until the first save."""
+    global _metadata_cache
+    if _metadata_cache is not None:
+        return _metadata_cache
 
-async def get_metadata() -> dict:
-    """Get metadata from database."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT key, value FROM metadata") as cursor:
-            rows = await cursor.fetchall()
-            return {row[0]: row[1] for row in rows}
+    async with db.execute("SELECT time_posted, next_scheduled_post_time FROM metadata") as cursor:
+        row = await cursor.fetchone()
+    async with db.execute("SELECT region, last_updated FROM regions") as cursor:
+        regions = {row[0]: row[1] for row in await cursor.fetchall()}
+    metadata = {**(dict(row) if row else {}), "regions": regions}
+    if _metadata_cache is None:
+        _metadata_cache = metadata
+    return metadata
 
 
-async def get_countries(region: str) -> dict[str, str]:
+async def get_countries(db: aiosqlite.Connection, region: str) -> dict[str, str]:
     """Get unique countries for a region."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-                "SELECT DISTINCT UPPER(country) FROM players WHERE region = ? AND country IS NOT NULL",
-                (region,),
-        ) as cursor:
-            codes = [row[0] for row in await cursor.fetchall()]
-
-    countries_full = {}
-    for code in codes:
-        country = countries_by_alpha2.get(code)
-        if country:
-            countries_full[code] = country.name
-        else:
-            countries_full[code] = "Unknown"
-
-    return dict(sorted(countries_full.items(), key=lambda x: x[1]))
-
+    cached = _countries_cache.get(region)
+    if cached is not None:
+        return cached
+
+    version = _cache_version
+    async with db.execute(
+            "SELECT DISTINCT country FROM players WHERE region = ? AND country IS NOT NULL",
+            (region,),
+    ) as cursor:
+        codes = [row[0] for row in await cursor.fetchall()]
+
+    countries_full = {code: ALPHA2_TO_NAME.get(code, "Unknown") for code in codes}
+    result = dict(sorted(countries_full.items(), key=lambda x: x[1]))
+    if version == _cache_version:
+        _countries_cache[region] = result
+    return result
+
+
+async def scheduled_task(db: aiosqlite.Connection, session: aiohttp.ClientSession):
+    """Background task to update data on schedule.
+
+    Sleeps until the API's next scheduled post plus a small jitter once
+    every region has been fetched. When a fetch fails, misses a region or
+    the next post is already due, retries with jittered exponential
+    backoff capped at an hour, and never sleeps past a known next post.
+    """
+    attempt = 0
 
-async def scheduled_task():
-    """Background task to update data on schedule."""
     while True:
+        next_update = 0
+        complete = False
         try:
-            data = await fetch_leaderboards()
+            data = await fetch_leaderboards(session)
             if data:
-                await save_to_db(data)
-                print(f"Data updated: {time.strftime('%H:%M:%S')}")
-
+                saved = await save_to_db(db, data)
+                if saved:
+                    print(f"Data updated ({', '.join(saved)}): {time.strftime('%H:%M:%S')}")
                 next_update = data.get("next_scheduled_post_time", 0)
-                now = int(time.time())
-
-                if next_update > now:
-                    sleep_for = (next_update - now) + 300
-                    print(f"Next update in {sleep_for // 60} minutes")
-                    await asyncio.sleep(sleep_for)
-                else:
-                    await asyncio.sleep(3600)
-            else:
-                await asyncio.sleep(300)
+                complete = len(data["region_time_posted"]) == len(REGIONS)
         except Exception as e:
             print(f"Error updating data: {e}")
-            await asyncio.sleep(60)
+
+        now = time.time()
+        until_next_post = (next_update - now) + random.uniform(5, 30)
+        if complete and next_update > now:
+            attempt = 0
+            sleep_for = until_next_post
+            print(f"Next update in {int(sleep_for) // 60} minutes")
+        else:
+            sleep_for = min(3600, 60 * 2 ** attempt * random.uniform(0.8, 1.2))
+            if next_update > now:
+                sleep_for = min(sleep_for, until_next_post)
+            attempt = min(attempt + 1, 6)
+            print(f"Retrying in {int(sleep_for)} seconds")
+        await asyncio.sleep(sleep_for)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan handler."""
-    await init_db()
-    task = asyncio.create_task(scheduled_task())
+    writer = await connect_db()
+    await init_db(writer)
+    app.state.db = await connect_db()
+    app.state.http = create_http_session()
+    app.state.template = templates.get_template("main/main.html")
+    task = asyncio.create_task(scheduled_task(writer, app.state.http))
     yield
     task.cancel()
+    await app.state.http.close()
+    await writer.close()
+    await app.state.db.close()
 
 
 app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
+templates.env.bytecode_cache = FileSystemBytecodeCache()
 
 
 @app.get("/", response_class=RedirectResponse)
@@ -241,8 +406,8 @@ async def default_region():
 async def read_root(
         request: Request,
         region: str,
-        rank_from: int | None = Query(None),
-        rank_to: int | None = Query(None),
+        rank_from: int | None = Query(None, ge=1, le=MAX_RANK),
+        rank_to: int | None = Query(None, ge=1, le=MAX_RANK),
         countries: str | None = Query(None),
         team: str | None = Query(None),
         name_player: str | None = Query(None),
@@ -252,22 +417,40 @@ async def read_root(
 
     selected_countries = countries.split(",") if countries else []
 
-    players = await get_players(
-        region=region,
-        rank_from=rank_from,
-        rank_to=rank_to,
-        countries=selected_countries if selected_countries else None,
-        team=team,
-        name_player=name_player,
-    )
+    db = request.app.state.db
+    metadata = await get_metadata(db)
 
-    metadata = await get_metadata()
-    countries_list = await get_countries(region)
+    etag_source = (
+        f"{metadata.get('time_posted')}|{metadata.get('next_scheduled_post_time')}"
+        f"|{metadata['regions'].get(region)}|{region}|{rank_from}|{rank_to}|{team}|{name_player}"
+        f"|{','.join(selected_countries)}"
+    )
+    etag = f'"{hashlib.blake2b(etag_source.encode(), digest_size=16).hexdigest()}"'
+    cache_headers = {"ETag": etag, "Cache-Control": "private, max-age=60"}
+
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+
+    cached = _page_cache.get(etag)
+    if cached is not None:
+        return HTMLResponse(cached, headers=cache_headers)
+
+    players, countries_list = await asyncio.gather(
+        get_players(
+            db,
+            region=region,
+            rank_from=rank_from,
+            rank_to=rank_to,
+            countries=selected_countries if selected_countries else None,
+            team=team,
+            name_player=name_player,
+        ),
+        get_countries(db, region),
+    )
 
-    return templates.TemplateResponse(
-        request=request,
-        name="main/main.html",
-        context={
+    html = await asyncio.to_thread(
+        request.app.state.template.render,
+        {
             "region": region,
             "data": players,
             "last_update": metadata.get("time_posted"),
@@ -280,3 +463,5 @@ async def read_root(
             "selected_countries": selected_countries,
         },
     )
+    _page_cache[etag] = html
+    return HTMLResponse(html, headers=cache_headers)